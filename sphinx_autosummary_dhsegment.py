@@ -6,16 +6,16 @@ import inspect
 import pkgutil
 import posixpath
 import re
-from typing import List, Tuple
+import string
+from typing import Any, List, NamedTuple, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
 
 import sphinx.ext.autosummary.generate as generate
-from dh_segment_torch.config import Registrable
 from docutils import nodes
 from docutils.nodes import Node
 from docutils.statemachine import StringList
 from sphinx import addnodes
 from sphinx.ext.autodoc.directive import DocumenterBridge, Options
-from sphinx.ext.autodoc.importer import import_module
 from sphinx.ext.autosummary import (
     autosummary_table,
     get_import_prefixes_from_env,
@@ -29,19 +29,53 @@ from sphinx.util.docutils import switch_source_input
 from sphinx.util.matching import Matcher
 
 ignore_modules = set()
-orig_find_autosummary_in_lines = generate.find_autosummary_in_lines
+_AUTOSUMMARY_DHSEG_RE = re.compile(
+    r"^(\s*)\.\.\s+autosummarydhsegment::\s*([A-Za-z0-9_.]+)\s*$"
+)
+# Characters a name can start with in an autosummary directive content.
+_LEAD_CHARS = frozenset("~_" + string.ascii_letters)
+# Characters that can start inline markup, references or standalone links.
+_RST_SPECIAL_CHARS = frozenset("`*|_[]\\:<>@")
+# Characters that would need escaping in the title or target of a role.
+_XREF_SPECIAL_CHARS = frozenset("`<>\\")
+_RST_ENUMERATOR_RE = re.compile(r"^(\w+|#)[.)]\s")
+_exclude_matcher_cache = WeakKeyDictionary()
+# Unwrapped in case generate is already patched by another import of this
+# module, re-derived in setup before patching.
+orig_find_autosummary_in_lines = getattr(
+    generate.find_autosummary_in_lines,
+    "_dhsegment_orig",
+    generate.find_autosummary_in_lines,
+)
 logger = logging.getLogger(__name__)
 
 
-def get_package_modules(pkgname):
-    """Returns a list of module names within the given package."""
-    if pkgname in ignore_modules:
-        return []
+def _probe_module(fullname):
+    """Returns *fullname* if the module can be located, None otherwise.
+
+    The module is not executed, autosummary imports it later if needed."""
+    try:
+        if importlib.util.find_spec(fullname) is None:
+            return None
+    except (ImportError, ValueError) as exc:
+        logger.debug("Skipping %s: %s", fullname, exc)
+        return None
+    return fullname
+
+
+@functools.lru_cache(maxsize=None)
+def get_package_modules(pkgname, ignored=frozenset()):
+    """Returns a tuple of module names within the given package.
+
+    *ignored* is a frozenset of module names to skip, it is part of the cache key
+    so that changes to ``ignore_modules`` are taken into account."""
+    if pkgname in ignored:
+        return ()
 
     spec = importlib.util.find_spec(pkgname)
     if not spec:
         logger.warning("Failed to find module {0}".format(pkgname))
-        return []
+        return ()
 
     path = spec.submodule_search_locations
 
@@ -51,40 +85,29 @@ def get_package_modules(pkgname):
         # modules on sys.path, which will have all sorts of hilarious effects
         # like reading out the Zen of Python and opening xkcd #353 in the web
         # browser.)
-        return []
+        return ()
 
     names = []
     for importer, modname, ispkg in pkgutil.iter_modules(path):
         fullname = pkgname + "." + modname
-        if fullname in ignore_modules:
-            continue
-
-        # Try importing the module; if we can't, then don't add it to the list.
-        try:
-            import_module(fullname)
-        except ImportError:
-            logger.exception("Failed to import {0}".format(fullname))
+        if fullname in ignored:
             continue
 
-        names.append(fullname)
+        if _probe_module(fullname):
+            names.append(fullname)
 
-    return names
+    return tuple(names)
 
 
 def find_autosummary_in_lines(lines, module=None, filename=None):
     """Overrides the autosummary version of this function to dynamically expand
     an autosummarydhsegment directive into a regular autosummary directive."""
 
-    autosummarydhsegment_re = re.compile(
-        r"^(\s*)\.\.\s+autosummarydhsegment::\s*([A-Za-z0-9_.]+)\s*$"
-    )
-
-    lines = list(lines)
     new_lines = []
 
-    while lines:
-        line = lines.pop(0)
-        m = autosummarydhsegment_re.match(line)
+    lines_iter = iter(lines)
+    for line in lines_iter:
+        m = _AUTOSUMMARY_DHSEG_RE.match(line)
         if m:
             base_indent = m.group(1)
             name = m.group(2).strip()
@@ -92,9 +115,7 @@ def find_autosummary_in_lines(lines, module=None, filename=None):
             new_lines.append(base_indent + ".. autosummary::")
 
             # Pass on any options.
-            while lines:
-                line = lines.pop(0)
-
+            for line in lines_iter:
                 if line.strip() and not line.startswith(base_indent + " "):
                     # Deindented line, so end of the autosummary block.
                     break
@@ -104,7 +125,7 @@ def find_autosummary_in_lines(lines, module=None, filename=None):
             if new_lines[-1].strip():
                 new_lines.append("")
 
-            for subname in get_package_modules(name):
+            for subname in get_package_modules(name, frozenset(ignore_modules)):
                 new_lines.append(base_indent + "   " + subname)
 
             new_lines.append("")
@@ -142,10 +163,22 @@ def get_class_that_defined_method(meth):
     return getattr(meth, "__objclass__", None)  # handle special descriptor objects
 
 
+@functools.lru_cache(maxsize=None)
+def get_registrable():
+    """Lazily imports dh_segment_torch ``Registrable``, returns None if it is
+    not installed."""
+    try:
+        from dh_segment_torch.config import Registrable
+    except ImportError:
+        return None
+    return Registrable
+
+
 def find_method_config_type(method):
     type_ = None
     default = None
 
+    Registrable = get_registrable()
     obj = get_class_that_defined_method(method)
     if obj:
 
@@ -171,6 +204,7 @@ def find_method_config_type(method):
 def find_class_config_type(obj):
     type_ = None
     default = None
+    Registrable = get_registrable()
     if issubclass(obj, Registrable):
         method_resolution_order = inspect.getmro(obj)
         for base_class in method_resolution_order:
@@ -183,7 +217,9 @@ def find_class_config_type(obj):
     return type_, default
 
 
-def find_config_type(item):
+def _find_config_type(item):
+    if get_registrable() is None:
+        return None
     if inspect.isclass(item):
         type_, default = find_class_config_type(item)
     else:
@@ -199,20 +235,78 @@ def find_config_type(item):
     return type_
 
 
+_find_config_type_cached = functools.lru_cache(maxsize=4096)(_find_config_type)
+
+
+def find_config_type(item):
+    """Returns the formatted config type of *item*, the result is cached
+    for hashable items."""
+    try:
+        hash(item)
+    except TypeError:
+        # Unhashable objects (e.g. some module-level data) cannot be cached.
+        return _find_config_type(item)
+    return _find_config_type_cached(item)
+
+
+def config_type_node(config_type: Optional[str]) -> nodes.paragraph:
+    """Builds the paragraph node for a config type as returned by
+    :func:`find_config_type`, without going through the RST parser."""
+    if not config_type:
+        return nodes.paragraph("")
+    if config_type.startswith("**"):
+        return nodes.paragraph("", "", nodes.strong("", config_type[2:-2]))
+    if config_type.startswith("*"):
+        return nodes.paragraph("", "", nodes.emphasis("", config_type[1:-1]))
+    return nodes.paragraph("", "", nodes.Text(config_type))
+
+
+def is_plain_text(text: str) -> bool:
+    """Returns True if the single line *text* would be parsed by docutils as a
+    simple paragraph without any markup."""
+    return (
+        bool(text)
+        and text[0].isalnum()
+        and _RST_SPECIAL_CHARS.isdisjoint(text)
+        and not _RST_ENUMERATOR_RE.match(text)
+    )
+
+
+def get_exclude_matcher(config):
+    """Returns a :class:`Matcher` for ``config.exclude_patterns``, built once
+    per config."""
+    matcher = _exclude_matcher_cache.get(config)
+    if matcher is None:
+        matcher = Matcher(config.exclude_patterns)
+        _exclude_matcher_cache[config] = matcher
+    return matcher
+
+
+class Row(NamedTuple):
+    """A row of the autosummary table, see :meth:`Autosummarydhsegment.get_items`."""
+
+    display_name: str
+    sig: str
+    summary: str
+    real_name: str
+    config_type: Optional[str]
+
+
 class Autosummarydhsegment(Autosummary):
     """Extends Autosummary to add a column with config name if it exists
     It takes a single argument, the name of the package."""
 
+    bridge = None
+
     def run(self) -> List[Node]:
-        self.bridge = DocumenterBridge(
-            self.env, self.state.document.reporter, Options(), self.lineno, self.state
-        )
+        names = []
+        for x in self.content:
+            x = x.strip()
+            if x and x[0] in _LEAD_CHARS:
+                names.append(x.split(None, 1)[0])
+        if not names:
+            return []
 
-        names = [
-            x.strip().split()[0]
-            for x in self.content
-            if x.strip() and re.search(r"^[~a-zA-Z_]", x.strip()[0])
-        ]
         items = self.get_items(names)
         nodes = self.get_table(items)
 
@@ -221,13 +315,16 @@ class Autosummarydhsegment(Autosummary):
 
             tree_prefix = self.options["toctree"].strip()
             docnames = []
-            excluded = Matcher(self.config.exclude_patterns)
-            filename_map = self.config.autosummary_filename_map
-            for name, sig, summary, real_name, _ in items:
-                real_name = filename_map.get(real_name, real_name)
-                docname = posixpath.join(tree_prefix, real_name)
-                docname = posixpath.normpath(posixpath.join(dirname, docname))
-                if docname not in self.env.found_docs:
+            excluded = get_exclude_matcher(self.config)
+            # Local aliases and invariants for the per item loop.
+            get_filename = self.config.autosummary_filename_map.get
+            normpath = posixpath.normpath
+            found_docs = self.env.found_docs
+            prefix_dir = normpath(posixpath.join(dirname, tree_prefix)) + "/"
+            for item in items:
+                real_name = get_filename(item.real_name, item.real_name)
+                docname = normpath(prefix_dir + real_name)
+                if docname not in found_docs:
                     if excluded(self.env.doc2path(docname, None)):
                         msg = __(
                             "autosummary references excluded document %r. Ignored."
@@ -260,25 +357,50 @@ class Autosummarydhsegment(Autosummary):
 
         return nodes
 
-    def get_items(self, names: List[str]) -> List[Tuple[str, str, str, str, str]]:
-        prefixes = get_import_prefixes_from_env(self.env)
+    def get_items(self, names: List[str]) -> List[Row]:
+        if self.bridge is None:
+            self.bridge = DocumenterBridge(
+                self.env,
+                self.state.document.reporter,
+                Options(),
+                self.lineno,
+                self.state,
+            )
 
+        # Filled by import_by_name, names that fail to import are dropped from
+        # the items, so rows are matched through their real name.
+        self.resolved = {}
         items = super().get_items(names)
-        new_items = []
-        for name, item in zip(names, items):
-            if name.startswith("~"):
-                name = name[1:]
-            real_name, obj, parent, modname = import_by_name(name, prefixes=prefixes)
-            config_type = find_config_type(obj)
-            new_items.append((item[0], item[1], item[2], item[3], config_type))
-        return new_items
-
-    def get_table(self, items: List[Tuple[str, str, str, str, str]]) -> List[Node]:
+        prefixes = get_import_prefixes_from_env(self.env)
+        return [Row(*item, self.get_config_type(item[3], prefixes)) for item in items]
+
+    def import_by_name(
+        self, name: str, prefixes: List[str]
+    ) -> Tuple[str, Any, Any, str]:
+        # Only called by Autosummary.get_items from Sphinx 3.2 on.
+        real_name, obj, parent, modname = super().import_by_name(name, prefixes)
+        self.resolved[real_name] = obj
+        return real_name, obj, parent, modname
+
+    def get_config_type(self, real_name: str, prefixes: List[str]) -> Optional[str]:
+        """Returns the config type of the object with the given *real_name*,
+        reusing the object resolved by :meth:`import_by_name` when possible."""
+        if real_name in self.resolved:
+            obj = self.resolved[real_name]
+        else:
+            try:
+                _, obj, _, _ = import_by_name(real_name, prefixes)
+            except ImportError:
+                # e.g. instance attributes, which import_by_name cannot resolve
+                return None
+        return find_config_type(obj)
+
+    def get_table(self, items: List[Row]) -> List[Node]:
         """Generate a proper list of table nodes for autosummary:: directive.
         *items* is a list produced by :meth:`get_items`.
         """
 
-        has_config_type = any([item[-1] is not None for item in items])
+        has_config_type = any(item.config_type is not None for item in items)
         if has_config_type:
             n_cols = 3
         else:
@@ -302,32 +424,28 @@ class Autosummarydhsegment(Autosummary):
         if not has_config_type:
             del cols[1]
         row = nodes.row("")
-        source, line = self.state_machine.get_source_and_line()
         for text in cols:
-            node = nodes.paragraph("")
-            vl = StringList()
-            vl.append(text, "%s:%d:<autosummary>" % (source, line))
-            with switch_source_input(self.state, vl):
-                self.state.nested_parse(vl, 0, node)
-                try:
-                    if isinstance(node[0], nodes.paragraph):
-                        node = node[0]
-                except IndexError:
-                    pass
-                row.append(nodes.entry("", node))
+            # Headers are plain text, no need to go through the RST parser.
+            row.append(nodes.entry("", nodes.paragraph("", "", nodes.Text(text))))
         head.append(row)
         group.append(head)
 
         body = nodes.tbody("")
         group.append(body)
 
-        def append_row(*column_texts: str) -> None:
+        source, line = self.state_machine.get_source_and_line()
+        location = "%s:%d:<autosummary>" % (source, line)
+
+        def append_row(*columns: Union[str, Node]) -> None:
             row = nodes.row("")
-            source, line = self.state_machine.get_source_and_line()
-            for text in column_texts:
+            for text in columns:
+                if isinstance(text, Node):
+                    # Already built node, no parsing needed.
+                    row.append(nodes.entry("", text))
+                    continue
                 node = nodes.paragraph("")
                 vl = StringList()
-                vl.append(text, "%s:%d:<autosummary>" % (source, line))
+                vl.append(text, location)
                 with switch_source_input(self.state, vl):
                     self.state.nested_parse(vl, 0, node)
                     try:
@@ -338,20 +456,52 @@ class Autosummarydhsegment(Autosummary):
                     row.append(nodes.entry("", node))
             body.append(row)
 
-        for name, sig, summary, real_name, config_type in items:
+        default_domain = self.env.temp_data.get("default_domain")
+        build_xref = (
+            "nosignatures" in self.options
+            and getattr(default_domain, "name", None) == "py"
+        )
+
+        def obj_xref_node(title: str, target: str) -> nodes.paragraph:
+            """Same node as the one produced by parsing :obj:`title <target>`."""
+            literal = nodes.literal("", title, classes=["xref", "py", "py-obj"])
+            xref = addnodes.pending_xref(
+                "",
+                literal,
+                refdoc=self.env.docname,
+                refdomain="py",
+                reftype="obj",
+                reftarget=target,
+                refexplicit=True,
+                refwarn=False,
+            )
+            xref["py:module"] = self.env.ref_context.get("py:module")
+            xref["py:class"] = self.env.ref_context.get("py:class")
+            # Same location as the nodes parsed from the location StringList.
+            xref.source, xref.line = location, 1
+            return nodes.paragraph("", "", xref)
+
+        for item in items:
             qualifier = "obj"
-            if "nosignatures" not in self.options:
+            if build_xref and _XREF_SPECIAL_CHARS.isdisjoint(
+                item.display_name + item.real_name
+            ):
+                col1 = obj_xref_node(item.display_name, item.real_name)
+            elif "nosignatures" not in self.options:
                 col1 = ":%s:`%s <%s>`\\ %s" % (
                     qualifier,
-                    name,
-                    real_name,
-                    rst.escape(sig),
+                    item.display_name,
+                    item.real_name,
+                    rst.escape(item.sig),
                 )
             else:
-                col1 = ":%s:`%s <%s>`" % (qualifier, name, real_name)
-            col2 = summary
+                col1 = ":%s:`%s <%s>`" % (qualifier, item.display_name, item.real_name)
+            if is_plain_text(item.summary):
+                col2 = nodes.paragraph("", "", nodes.Text(item.summary))
+            else:
+                col2 = item.summary
             if has_config_type:
-                col3 = config_type if config_type else ""
+                col3 = config_type_node(item.config_type)
                 append_row(col1, col3, col2)
             else:
                 append_row(col1, col2)
@@ -359,15 +509,30 @@ class Autosummarydhsegment(Autosummary):
 
 
 def on_config_inited(app, config):
+    _exclude_matcher_cache.pop(config, None)
     for mod in config.autosummary_mock_imports:
         ignore_modules.add(mod)
 
 
+def on_env_before_read_docs(app, env, docnames):
+    # Modules and Registrable types can change between builds in the same
+    # process, so do not keep stale lookups around.
+    get_package_modules.cache_clear()
+    _find_config_type_cached.cache_clear()
+
+
 def setup(app):
+    global orig_find_autosummary_in_lines
+    current = generate.find_autosummary_in_lines
+    # If already patched, possibly by another import of this module, reuse the
+    # real original instead of wrapping the patched version.
+    orig_find_autosummary_in_lines = getattr(current, "_dhsegment_orig", current)
+    find_autosummary_in_lines._dhsegment_orig = orig_find_autosummary_in_lines
     generate.find_autosummary_in_lines = find_autosummary_in_lines
 
     app.add_directive("autosummarydhsegment", Autosummarydhsegment)
     app.connect("config-inited", on_config_inited)
+    app.connect("env-before-read-docs", on_env_before_read_docs)
 
     app.add_config_value("autosummary_filename_map", {}, "html")
 